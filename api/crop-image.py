@@ -1,9 +1,21 @@
 import os
 import json
 import requests
+from urllib3.util.retry import Retry
 
 PYTHON_API_URL = os.getenv("PYTHON_API_URL", "https://your-api.onrender.com")
 
+# Reuse the TCP/TLS connection to the Python API across invocations of a warm function
+HTTP_SESSION = requests.Session()
+_http_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    # Retry failed connects only, never a request the API may already be processing
+    max_retries=Retry(total=2, connect=2, read=False),
+)
+HTTP_SESSION.mount("https://", _http_adapter)
+HTTP_SESSION.mount("http://", _http_adapter)
+
 def handler(req):
     try:
         # Handle OPTIONS
@@ -54,7 +66,7 @@ def handler(req):
             payload["bounding_boxes"] = data["bounding_boxes"]
         
         # Call Python API
-        resp = requests.post(
+        resp = HTTP_SESSION.post(
             f"{PYTHON_API_URL}/crop-image",
             json=payload,
             timeout=60
@@ -44,17 +44,26 @@ import uuid
 import io
 import shutil
 import base64
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
 from pathlib import Path
 from typing import List, Optional, Dict, Any
 
 import requests
+from urllib3.util.retry import Retry
 from PIL import Image
 from fastapi import FastAPI, HTTPException, Body
-from fastapi.responses import JSONResponse
 from pydantic import BaseModel, HttpUrl
 
-app = FastAPI(title="Image to Image Generator", version="1.1.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm up detection before serving requests."""
+    warm_up_detection()
+    yield
+
+
+app = FastAPI(title="Image to Image Generator", version="1.1.0", lifespan=lifespan)
 
 OUTPUT_DIR = Path(os.getenv("OUTPUT_DIR", "./cropped_images")).resolve()
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
@@ -64,6 +73,37 @@ SAVE_LOCAL = os.getenv("SAVE_LOCAL", "true").lower() in ("1", "true", "yes")
 # Cleanup: delete job dirs older than this many minutes (0 = disable). Keeps disk from growing.
 CROP_JOB_MAX_AGE_MINUTES = int(os.getenv("CROP_JOB_MAX_AGE_MINUTES", "60"))
 YOLO_MODEL = None
+# Optional TensorRT engine exported offline (see README); used instead of yolov8n.pt when the file exists.
+YOLO_ENGINE_PATH = Path(os.getenv("YOLO_ENGINE_PATH", "yolov8n.engine"))
+# Longest side used for edge/contour window detection; larger images are downscaled first.
+WINDOW_DETECTION_MAX_DIM = int(os.getenv("WINDOW_DETECTION_MAX_DIM", "1280"))
+# Caps on contour candidates collected / passed to overlap removal; busy interiors can yield hundreds.
+WINDOW_MAX_CANDIDATES = 128
+WINDOW_MAX_DEDUP_BOXES = 64
+# Input size for YOLO; matches the size the model was trained/exported at.
+YOLO_IMGSZ = 640
+# Half-precision inference; switched on in get_yolo_model() only when CUDA is available (FP16 is slower on CPU).
+YOLO_HALF = False
+# Images per YOLO forward pass and per download/process chunk; bounds GPU and host memory on large requests.
+YOLO_MAX_BATCH = 16
+# JPEG quality for encoded crops; 85 is visually indistinguishable from 95 on crops at well under half the bytes.
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "85"))
+# One pooled HTTP session for downloads and uploads, so repeated calls to a host reuse keep-alive connections.
+HTTP_SESSION = requests.Session()
+_http_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    # Retry failed connects only; a stalled host should fail after one read timeout, not three
+    max_retries=Retry(total=2, connect=2, read=False),
+)
+HTTP_SESSION.mount("https://", _http_adapter)
+HTTP_SESSION.mount("http://", _http_adapter)
+# Shared PyTurboJPEG handle for lossless JPEG cropping; False once we know libturbojpeg is unavailable.
+TURBOJPEG = None
+# Single worker that deletes old outputs in the background, one purge at a time.
+CLEANUP_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+# Concurrent downloads per request; downloads are network-bound so threads overlap the round trips.
+DOWNLOAD_MAX_WORKERS = int(os.getenv("DOWNLOAD_MAX_WORKERS", "8"))
 
 
 class BoundingBox(BaseModel):
@@ -100,37 +140,163 @@ class CropRequest(BaseModel):
 
 
 def download_image(url: str) -> Image.Image:
-    """Download image from URL."""
+    """Download image from URL, decoding straight from the response stream."""
+    response = None
     try:
-        response = requests.get(url, timeout=30, stream=True)
+        response = HTTP_SESSION.get(url, timeout=30, stream=True)
         response.raise_for_status()
-        image = Image.open(io.BytesIO(response.content))
+        # Let urllib3 undo any gzip/deflate transfer encoding while PIL reads
+        response.raw.decode_content = True
+        image = Image.open(response.raw)
+        # Decode now so the connection can be released before we return
+        image.load()
         # Convert to RGB if necessary
         if image.mode != "RGB":
             image = image.convert("RGB")
         return image
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to download image: {e}")
+    finally:
+        if response is not None:
+            response.close()
 
 
-def crop_bounding_box(image: Image.Image, bbox: BoundingBox) -> Image.Image:
-    """Crop a bounding box from an image."""
+def download_image_bytes(url: str) -> bytes:
+    """Download the encoded image bytes from URL without decoding them."""
+    try:
+        response = HTTP_SESSION.get(url, timeout=30)
+        response.raise_for_status()
+        return response.content
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to download image: {e}")
+
+
+def open_image_bytes(data: bytes) -> Image.Image:
+    """Decode downloaded image bytes to an RGB image."""
+    try:
+        image = Image.open(io.BytesIO(data))
+        # Convert to RGB if necessary
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return image
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to decode image: {e}")
+
+
+def encode_jpeg(image: Image.Image) -> bytes:
+    """Encode a crop with the JPEG settings used for every uploaded/saved file."""
+    buffer = io.BytesIO()
+    # 4:2:0 chroma subsampling, single-pass Huffman coding, baseline (non-progressive) scan
+    image.save(buffer, format="JPEG", quality=JPEG_QUALITY, subsampling=2, optimize=False, progressive=False)
+    return buffer.getvalue()
+
+
+def clamp_bounding_box(bbox: BoundingBox, image_width: int, image_height: int) -> tuple[int, int, int, int]:
+    """Clip a bounding box to the image and return (x, y, width, height)."""
     # Ensure coordinates are within image bounds
     x = max(0, bbox.x)
     y = max(0, bbox.y)
-    width = min(bbox.width, image.width - x)
-    height = min(bbox.height, image.height - y)
+    width = min(bbox.width, image_width - x)
+    height = min(bbox.height, image_height - y)
     
     if width <= 0 or height <= 0:
         raise HTTPException(status_code=400, detail=f"Invalid bounding box: {bbox}")
     
+    return x, y, width, height
+
+
+def crop_bounding_box(image: Image.Image, bbox: BoundingBox) -> Image.Image:
+    """Crop a bounding box from an image."""
+    x, y, width, height = clamp_bounding_box(bbox, image.width, image.height)
     return image.crop((x, y, x + width, y + height))
 
 
+def get_turbojpeg():
+    """Return the shared TurboJPEG handle, or None when PyTurboJPEG/libturbojpeg is not installed."""
+    global TURBOJPEG
+    if TURBOJPEG is None:
+        try:
+            from turbojpeg import TurboJPEG
+            TURBOJPEG = TurboJPEG()
+        except Exception:
+            TURBOJPEG = False
+    return TURBOJPEG or None
+
+
+def crop_jpeg_regions(
+    data: bytes,
+    boxes: List[BoundingBox]
+) -> Optional[List[Optional[tuple[bytes, int, int]]]]:
+    """
+    Crop boxes out of JPEG bytes at the DCT-block level instead of decoding the whole image;
+    each crop is then decoded on its own and re-encoded with encode_jpeg.
+    Returns (jpeg_bytes, width, height) per box, None for boxes outside the image,
+    or None overall when the fast path does not apply (PyTurboJPEG missing, not a YCbCr JPEG).
+    """
+    tj = get_turbojpeg()
+    if tj is None or not data.startswith(b"\xff\xd8"):
+        return None
+
+    try:
+        from turbojpeg import TJCS_YCbCr, tjMCUWidth, tjMCUHeight
+
+        image_width, image_height, subsample, colorspace = tj.decode_header(data)
+        if colorspace != TJCS_YCbCr:
+            return None
+        mcu_width = tjMCUWidth[subsample]
+        mcu_height = tjMCUHeight[subsample]
+
+        # Lossless crops must start on an MCU boundary: round the origin down and remember the margin
+        crop_parameters = []
+        regions: List[Optional[tuple[int, int, int, int]]] = []
+        for bbox in boxes:
+            try:
+                x, y, width, height = clamp_bounding_box(bbox, image_width, image_height)
+            except HTTPException:
+                regions.append(None)
+                continue
+            aligned_x = x - x % mcu_width
+            aligned_y = y - y % mcu_height
+            crop_parameters.append((aligned_x, aligned_y, x + width - aligned_x, y + height - aligned_y))
+            regions.append((x - aligned_x, y - aligned_y, width, height))
+
+        # copynone drops EXIF (GPS, thumbnail, Orientation) from the intermediate crops
+        crops = iter(tj.crop_multiple(data, crop_parameters, copynone=True) if crop_parameters else [])
+        results: List[Optional[tuple[bytes, int, int]]] = []
+        for region in regions:
+            if region is None:
+                results.append(None)
+                continue
+            dx, dy, width, height = region
+            # Decode only the small crop, trim the alignment margin and re-encode with the shared
+            # settings, so every crop has the same quality/subsampling whatever its origin
+            piece = open_image_bytes(next(crops)).crop((dx, dy, dx + width, dy + height))
+            results.append((encode_jpeg(piece), width, height))
+        return results
+    except Exception:
+        return None
+
+
+# str.translate table over ASCII: keeps letters, digits, '-' and '_' and maps everything else to '_'
+_FILENAME_CHARS = str.maketrans({
+    chr(codepoint): "_"
+    for codepoint in range(128)
+    if not (chr(codepoint).isalnum() or chr(codepoint) in ("-", "_"))
+})
+
+
+def _safe_filename_part(value: str) -> str:
+    """Replace anything but alphanumerics, '-' and '_' with '_'."""
+    if value.isascii():
+        return value.translate(_FILENAME_CHARS)
+    # Non-ASCII labels keep the str.isalnum() rules (e.g. accented letters survive)
+    return "".join(c if c.isalnum() or c in ("-", "_") else "_" for c in value)
+
+
 def _safe_token(value: Optional[Any], fallback: str) -> str:
     """Create a compact filename-safe token for source labels."""
     raw = str(value).strip() if value is not None else fallback
-    token = "".join(c if c.isalnum() or c in ("-", "_") else "_" for c in raw)
+    token = _safe_filename_part(raw)
     return token or fallback
 
 
@@ -175,66 +341,122 @@ def _detection_available() -> bool:
 
 def get_yolo_model():
     """Load YOLO once per process so retry passes do not repeatedly initialize it."""
-    global YOLO_MODEL
+    global YOLO_MODEL, YOLO_HALF
     if YOLO_MODEL is None:
+        import torch
         from ultralytics import YOLO
-        YOLO_MODEL = YOLO("yolov8n.pt")  # nano model for speed
+        YOLO_HALF = torch.cuda.is_available()
+        if YOLO_ENGINE_PATH.is_file():
+            try:
+                engine = YOLO(str(YOLO_ENGINE_PATH), task="detect")
+                # Ultralytics only builds the TensorRT backend on the first predict, so force it here
+                engine(Image.new("RGB", (YOLO_IMGSZ, YOLO_IMGSZ)), imgsz=YOLO_IMGSZ, half=YOLO_HALF, verbose=False)
+                YOLO_MODEL = engine
+            except Exception:
+                # No GPU/TensorRT on this host, or an engine built for another GPU: use the PyTorch weights
+                YOLO_MODEL = None
+        if YOLO_MODEL is None:
+            YOLO_MODEL = YOLO("yolov8n.pt")  # nano model for speed
     return YOLO_MODEL
 
 
-def detect_objects(image: Image.Image, confidence_threshold: float = 0.5, windows_only: bool = False) -> List[BoundingBox]:
+def warm_up_detection() -> None:
     """
-    Detect objects in image using YOLO or advanced window detection.
-    If windows_only=True, uses advanced image processing to detect window frames.
-    In light builds (requirements-light.txt), detection is unavailable; send bounding_boxes instead.
+    Pay the YOLO weight load and first-inference setup at boot instead of on the first request.
+    A dummy forward pass triggers CUDA kernel loading / cuDNN algorithm selection (or TensorRT
+    context creation) and a tiny Canny call starts OpenCV's thread pool.
+    """
+    if not _detection_available():
+        return
+    try:
+        model = get_yolo_model()
+        dummy = Image.new("RGB", (YOLO_IMGSZ, YOLO_IMGSZ))
+        model(dummy, conf=0.5, imgsz=YOLO_IMGSZ, half=YOLO_HALF, verbose=False)
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    except Exception:
+        # Leave it to the first request to surface load errors as a 500
+        pass
+
+    try:
+        import cv2
+        import numpy as np
+        cv2.Canny(np.zeros((YOLO_IMGSZ, YOLO_IMGSZ), np.uint8), 30, 100)
+    except Exception:
+        pass
+
+
+def _result_to_bboxes(result, image: Image.Image, names: Dict[int, str], windows_only: bool = False) -> List[BoundingBox]:
+    """Convert one YOLO result into bounding boxes, applying the window shape filter if requested."""
+    bounding_boxes = []
+    img_area = image.width * image.height
+    for box in result.boxes:
+        # Get box coordinates (x1, y1, x2, y2)
+        x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
+        x = int(x1)
+        y = int(y1)
+        width = int(x2 - x1)
+        height = int(y2 - y1)
+
+        # If windows_only, filter for rectangular objects that could be windows
+        if windows_only:
+            aspect_ratio = width / height if height > 0 else 0
+            area = width * height
+
+            # Filter for rectangular objects that could be windows
+            if (0.3 <= aspect_ratio <= 3.0 and
+                area > img_area * 0.005 and
+                area < img_area * 0.9):
+                bounding_boxes.append(BoundingBox(
+                    x=x, y=y, width=width, height=height, label="window"
+                ))
+        else:
+            # Get class label
+            cls = int(box.cls[0])
+            bounding_boxes.append(BoundingBox(
+                x=x, y=y, width=width, height=height, label=names[cls]
+            ))
+    return bounding_boxes
+
+
+def detect_objects_batch(
+    images: List[Image.Image],
+    confidence_threshold: float = 0.5,
+    windows_only: bool = False,
+    window_max_dim: Optional[int] = None
+) -> List[List[BoundingBox]]:
     """
+    Detect objects in several images, running YOLO once per batch of up to YOLO_MAX_BATCH images.
+    Returns one list of boxes per input image, in the same order.
+    window_max_dim overrides WINDOW_DETECTION_MAX_DIM for the contour pass.
+    """
+    detections: List[List[BoundingBox]] = [[] for _ in images]
+    pending = list(range(len(images)))
+
     # If windows_only, try OpenCV-based detection first (skipped if cv2 not installed)
     if windows_only:
-        bounding_boxes = detect_windows_advanced(image, confidence_threshold)
-        if bounding_boxes:
-            return bounding_boxes
-        # Fall through to YOLO if available
+        pending = []
+        for idx, image in enumerate(images):
+            detections[idx] = detect_windows_advanced(image, confidence_threshold, max_dim=window_max_dim)
+            if not detections[idx]:
+                # Fall through to YOLO if available
+                pending.append(idx)
+
+    if not pending:
+        return detections
 
     try:
         model = get_yolo_model()
 
-        # Run inference
-        results = model(image, conf=confidence_threshold)
+        for start in range(0, len(pending), YOLO_MAX_BATCH):
+            chunk = pending[start:start + YOLO_MAX_BATCH]
+            # Run inference on the whole chunk in one forward pass
+            results = model([images[idx] for idx in chunk], conf=confidence_threshold, imgsz=YOLO_IMGSZ, half=YOLO_HALF)
+            for idx, result in zip(chunk, results):
+                detections[idx] = _result_to_bboxes(result, images[idx], model.names, windows_only)
 
-        bounding_boxes = []
-        for result in results:
-            boxes = result.boxes
-            for box in boxes:
-                # Get box coordinates (x1, y1, x2, y2)
-                x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                x = int(x1)
-                y = int(y1)
-                width = int(x2 - x1)
-                height = int(y2 - y1)
-
-                # Get class label
-                cls = int(box.cls[0])
-                label = model.names[cls]
-
-                # If windows_only, filter for rectangular objects that could be windows
-                if windows_only:
-                    aspect_ratio = width / height if height > 0 else 0
-                    area = width * height
-                    img_area = image.width * image.height
-
-                    # Filter for rectangular objects that could be windows
-                    if (0.3 <= aspect_ratio <= 3.0 and
-                        area > img_area * 0.005 and
-                        area < img_area * 0.9):
-                        bounding_boxes.append(BoundingBox(
-                            x=x, y=y, width=width, height=height, label="window"
-                        ))
-                else:
-                    bounding_boxes.append(BoundingBox(
-                        x=x, y=y, width=width, height=height, label=label
-                    ))
-
-        return bounding_boxes
+        return detections
     except ImportError:
         raise HTTPException(
             status_code=400,
@@ -247,17 +469,38 @@ def detect_objects(image: Image.Image, confidence_threshold: float = 0.5, window
         raise HTTPException(status_code=500, detail=f"Object detection failed: {e}")
 
 
+def detect_objects(
+    image: Image.Image,
+    confidence_threshold: float = 0.5,
+    windows_only: bool = False,
+    window_max_dim: Optional[int] = None
+) -> List[BoundingBox]:
+    """
+    Detect objects in image using YOLO or advanced window detection.
+    If windows_only=True, uses advanced image processing to detect window frames.
+    In light builds (requirements-light.txt), detection is unavailable; send bounding_boxes instead.
+    """
+    return detect_objects_batch(
+        [image], confidence_threshold, windows_only=windows_only, window_max_dim=window_max_dim
+    )[0]
+
+
 def detect_objects_with_retries(
     image: Image.Image,
     confidence_threshold: float = 0.5,
-    windows_only: bool = False
+    windows_only: bool = False,
+    initial_boxes: Optional[List[BoundingBox]] = None
 ) -> tuple[List[BoundingBox], List[str]]:
     """
     Try a small number of detection passes before declaring a miss.
     This keeps looped PDF processing simple while reducing false negatives.
+    Pass initial_boxes when the first pass already ran as part of a batch.
     """
     attempts: List[str] = []
-    boxes = detect_objects(image, confidence_threshold, windows_only=windows_only)
+    if initial_boxes is None:
+        boxes = detect_objects(image, confidence_threshold, windows_only=windows_only)
+    else:
+        boxes = initial_boxes
     if boxes:
         attempts.append(f"detected {len(boxes)} at threshold {confidence_threshold}")
         return boxes, attempts
@@ -277,7 +520,13 @@ def detect_objects_with_retries(
         scale = 1.5
         attempts.append(f"retrying with {scale}x upscale")
         upscaled = image.resize((int(image.width * scale), int(image.height * scale)))
-        upscale_boxes = detect_objects(upscaled, retry_used, windows_only=windows_only)
+        # Raise the contour-pass size limit by the same factor, otherwise it would shrink the upscale straight back
+        upscale_boxes = detect_objects(
+            upscaled,
+            retry_used,
+            windows_only=windows_only,
+            window_max_dim=int(WINDOW_DETECTION_MAX_DIM * scale)
+        )
         if upscale_boxes:
             scaled_boxes = [
                 BoundingBox(
@@ -296,60 +545,97 @@ def detect_objects_with_retries(
     return [], attempts
 
 
-def detect_windows_advanced(image: Image.Image, confidence_threshold: float = 0.5) -> List[BoundingBox]:
+def detect_windows_advanced(
+    image: Image.Image,
+    confidence_threshold: float = 0.5,
+    max_dim: Optional[int] = None
+) -> List[BoundingBox]:
     """
     Advanced window detection using image processing techniques.
-    Detects rectangular regions that could be windows using multiple methods.
+    Detects rectangular regions that could be windows from edge contours and PDF drawing colors.
+    The contour pass runs on a copy no larger than max_dim (default WINDOW_DETECTION_MAX_DIM).
     """
     try:
         import cv2
         import numpy as np
         
-        # Convert PIL to OpenCV format
-        img_array = np.array(image)
-
-        img_cv = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
-        gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
+        # Full-resolution RGB array, built only once and only when a pass needs it. np.asarray still
+        # copies PIL's pixels (via tobytes()), but unlike np.array it skips a second NumPy copy.
+        img_array = None
+
+        # Edge/contour detection gains nothing above ~1280px, so run it on a downscaled copy
+        scale = min(1.0, (max_dim or WINDOW_DETECTION_MAX_DIM) / max(image.width, image.height))
+        if scale < 1.0:
+            work_image = image.resize((int(image.width * scale), int(image.height * scale)), Image.BILINEAR)
+            gray = cv2.cvtColor(np.asarray(work_image), cv2.COLOR_RGB2GRAY)
+        else:
+            work_image = image
+            img_array = np.asarray(image)
+            gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
         
-        # Method 1: Edge detection and contour finding
+        # Edge detection and contour finding
         edges = cv2.Canny(gray, 30, 100, apertureSize=3)
         
-        # Dilate edges to connect nearby edges
+        # Dilate edges in place to connect nearby edges (the raw edge map is not needed afterwards)
         kernel = np.ones((3, 3), np.uint8)
-        dilated = cv2.dilate(edges, kernel, iterations=2)
+        cv2.dilate(edges, kernel, dst=edges, iterations=1)
         
         # Find contours
-        contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         
         bounding_boxes = []
-        img_area = image.width * image.height
+        img_area = work_image.width * work_image.height
         min_area = img_area * 0.005  # At least 0.5% of image
         max_area = img_area * 0.9    # Max 90% of image
         
-        # Method 2: HoughLines to detect rectangular structures
-        lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=50, minLineLength=30, maxLineGap=10)
+        # One contourArea pass, then a vectorized gate: only contours with 4+ points (anything fewer can
+        # never approximate to a rectangle) inside the area range reach the per-contour shape tests
+        areas = np.fromiter((cv2.contourArea(c) for c in contours), dtype=np.float64, count=len(contours))
+        point_counts = np.fromiter((len(c) for c in contours), dtype=np.int64, count=len(contours))
+        candidates = np.nonzero((point_counts >= 4) & (areas >= min_area) & (areas <= max_area))[0]
+        # Largest contours first, so the candidate cap keeps the most significant shapes
+        candidates = candidates[np.argsort(-areas[candidates], kind="stable")]
         
         # Process contours
-        for contour in contours:
-            area = cv2.contourArea(contour)
-            if min_area <= area <= max_area:
-                # Get bounding rectangle
-                x, y, w, h = cv2.boundingRect(contour)
-                
-                # Filter for rectangular shapes (windows are typically rectangular)
-                aspect_ratio = w / h if h > 0 else 0
-                if 0.3 <= aspect_ratio <= 3.0:  # More flexible
-                    # Check if it's roughly rectangular (contour approximation)
-                    epsilon = 0.02 * cv2.arcLength(contour, True)
-                    approx = cv2.approxPolyDP(contour, epsilon, True)
-                    if len(approx) >= 4:  # At least 4 vertices (rectangular)
-                        bounding_boxes.append(BoundingBox(
-                            x=x, y=y, width=w, height=h, label="window"
-                        ))
+        for idx in candidates:
+            if len(bounding_boxes) >= WINDOW_MAX_CANDIDATES:
+                break
+            contour = contours[idx]
+            # Get bounding rectangle
+            x, y, w, h = cv2.boundingRect(contour)
+            
+            # Filter for rectangular shapes (windows are typically rectangular)
+            aspect_ratio = w / h if h > 0 else 0
+            if 0.3 <= aspect_ratio <= 3.0:  # More flexible
+                # Check if it's roughly rectangular (contour approximation)
+                epsilon = 0.02 * cv2.arcLength(contour, True)
+                approx = cv2.approxPolyDP(contour, epsilon, True)
+                if len(approx) >= 4:  # At least 4 vertices (rectangular)
+                    bounding_boxes.append(BoundingBox(
+                        x=x, y=y, width=w, height=h, label="window"
+                    ))
+        
+        # Bound the dedup cost: only the largest candidates go through overlap removal
+        bounding_boxes.sort(key=lambda box: box.width * box.height, reverse=True)
+        bounding_boxes = bounding_boxes[:WINDOW_MAX_DEDUP_BOXES]
         
         # Remove overlapping/duplicate boxes
         bounding_boxes = remove_overlapping_boxes(bounding_boxes, overlap_threshold=0.5)
+        if scale < 1.0:
+            bounding_boxes = [
+                BoundingBox(
+                    x=int(box.x / scale),
+                    y=int(box.y / scale),
+                    width=int(box.width / scale),
+                    height=int(box.height / scale),
+                    label=box.label,
+                )
+                for box in bounding_boxes
+            ]
 
+        # Drawing thresholds are in absolute pixels, so this pass keeps the full-resolution pixels
+        if img_array is None:
+            img_array = np.asarray(image)
         drawing_boxes = detect_pdf_window_drawings(img_array)
         if drawing_boxes:
             return add_missing_boxes(bounding_boxes, drawing_boxes)
@@ -498,25 +784,23 @@ def boxes_refer_to_same_target(first: BoundingBox, second: BoundingBox) -> bool:
     return smaller_area > 0 and intersection / smaller_area > 0.35
 
 
-def upload_to_cloud_storage(img_bytes: io.BytesIO, filename: str) -> str:
+def upload_to_cloud_storage(img_bytes: bytes, filename: str) -> str:
     """
-    Upload image to cloud storage and return URL.
+    Upload encoded JPEG bytes to cloud storage and return URL.
     Supports: ImgBB, Cloudinary, or returns base64 data URL as fallback.
     """
-    img_bytes.seek(0)
-    
     # Option 1: ImgBB (requires API key)
     imgbb_api_key = os.getenv("IMGBB_API_KEY", "")
     if imgbb_api_key:
         try:
-            img_base64 = base64.b64encode(img_bytes.read()).decode()
-            response = requests.post(
+            # Send the JPEG as a binary multipart file; base64 would add a third to the payload
+            response = HTTP_SESSION.post(
                 "https://api.imgbb.com/1/upload",
                 data={
                     "key": imgbb_api_key,
-                    "image": img_base64,
                     "name": filename
                 },
+                files={"image": (filename, img_bytes, "image/jpeg")},
                 timeout=30
             )
             if response.status_code == 200:
@@ -537,9 +821,8 @@ def upload_to_cloud_storage(img_bytes: io.BytesIO, filename: str) -> str:
                 api_key=os.getenv("CLOUDINARY_API_KEY"),
                 api_secret=os.getenv("CLOUDINARY_API_SECRET")
             )
-            img_bytes.seek(0)
             result = cloudinary.uploader.upload(
-                img_bytes,
+                io.BytesIO(img_bytes),
                 folder="cropped-images",
                 public_id=filename.replace(".jpg", "")
             )
@@ -548,8 +831,7 @@ def upload_to_cloud_storage(img_bytes: io.BytesIO, filename: str) -> str:
             pass
     
     # Option 3: Return base64 data URL (works but not ideal for large images)
-    img_bytes.seek(0)
-    img_base64 = base64.b64encode(img_bytes.read()).decode()
+    img_base64 = base64.b64encode(img_bytes).decode()
     return f"data:image/jpeg;base64,{img_base64}"
 
 
@@ -557,45 +839,48 @@ def remove_overlapping_boxes(boxes: List[BoundingBox], overlap_threshold: float
     """Remove overlapping bounding boxes, keeping the largest ones."""
     if not boxes:
         return boxes
-    
-    # Sort by area (largest first)
-    boxes_with_area = [(box, box.width * box.height) for box in boxes]
-    boxes_with_area.sort(key=lambda x: x[1], reverse=True)
-    
-    filtered = []
-    for box, _ in boxes_with_area:
-        is_overlapping = False
-        for existing_box in filtered:
-            # Calculate intersection over union (IoU)
-            x1 = max(box.x, existing_box.x)
-            y1 = max(box.y, existing_box.y)
-            x2 = min(box.x + box.width, existing_box.x + existing_box.width)
-            y2 = min(box.y + box.height, existing_box.y + existing_box.height)
-            
-            if x2 > x1 and y2 > y1:
-                intersection = (x2 - x1) * (y2 - y1)
-                area1 = box.width * box.height
-                area2 = existing_box.width * existing_box.height
-                union = area1 + area2 - intersection
-                iou = intersection / union if union > 0 else 0
-                
-                if iou > overlap_threshold:
-                    is_overlapping = True
-                    break
-        
-        if not is_overlapping:
-            filtered.append(box)
-    
-    return filtered
+
+    import numpy as np
+
+    coords = np.array(
+        [[box.x, box.y, box.x + box.width, box.y + box.height] for box in boxes],
+        dtype=np.float64,
+    )
+    areas = (coords[:, 2] - coords[:, 0]) * (coords[:, 3] - coords[:, 1])
+    # Sort by area (largest first); stable so equal areas keep input order
+    order = np.argsort(-areas, kind="stable")
+
+    keep: List[int] = []
+    for i in order:
+        if keep:
+            kept = coords[keep]
+            # Intersection over union (IoU) against every box kept so far
+            inter_w = np.minimum(coords[i, 2], kept[:, 2]) - np.maximum(coords[i, 0], kept[:, 0])
+            inter_h = np.minimum(coords[i, 3], kept[:, 3]) - np.maximum(coords[i, 1], kept[:, 1])
+            intersection = np.clip(inter_w, 0, None) * np.clip(inter_h, 0, None)
+            union = areas[i] + areas[keep] - intersection
+            iou = np.divide(intersection, union, out=np.zeros_like(union), where=union > 0)
+            if (iou > overlap_threshold).any():
+                continue
+        keep.append(int(i))
+
+    return [boxes[i] for i in keep]
 
 
 def process_single_image(
     image_url: str,
     request: CropRequest,
     job_dir: Path,
-    image_index: int = 0
+    image_index: int = 0,
+    image: Optional[Image.Image] = None,
+    detected_boxes: Optional[List[BoundingBox]] = None,
+    image_bytes: Optional[bytes] = None
 ) -> tuple[List[Dict[str, Any]], List[str], Dict[str, Any]]:
-    """Process a single image and return saved files, errors, and a source-level status."""
+    """
+    Process a single image and return saved files, errors, and a source-level status.
+    image and detected_boxes let the caller pass an already downloaded image and batched first-pass detections.
+    image_bytes passes the undecoded download instead, so manual boxes can be cropped from the JPEG directly.
+    """
     saved_files: List[Dict[str, Any]] = []
     errors: List[str] = []
     source = build_source_metadata(request, image_url, image_index)
@@ -610,7 +895,8 @@ def process_single_image(
     
     # Download image
     try:
-        image = download_image(image_url)
+        if image is None and image_bytes is None:
+            image = download_image(image_url)
     except HTTPException:
         raise
     except Exception as e:
@@ -628,7 +914,8 @@ def process_single_image(
             bounding_boxes, detection_attempts = detect_objects_with_retries(
                 image, 
                 request.confidence_threshold,
-                windows_only=request.detect_windows_only
+                windows_only=request.detect_windows_only,
+                initial_boxes=detected_boxes
             )
             source_item["detection_attempts"] = detection_attempts
             if not bounding_boxes:
@@ -655,11 +942,26 @@ def process_single_image(
         source_item["errors"].append(message)
         return saved_files, errors, source_item
     
+    # Crop straight from the JPEG bytes when possible; otherwise decode the full image
+    jpeg_crops = None
+    if image_bytes is not None:
+        jpeg_crops = crop_jpeg_regions(image_bytes, bounding_boxes)
+        if jpeg_crops is None:
+            image = open_image_bytes(image_bytes)
+    
     # Crop each bounding box (all windows will be cropped)
     window_count = 0
     for idx, bbox in enumerate(bounding_boxes):
         try:
-            cropped = crop_bounding_box(image, bbox)
+            if jpeg_crops is not None:
+                if jpeg_crops[idx] is None:
+                    raise HTTPException(status_code=400, detail=f"Invalid bounding box: {bbox}")
+                payload, crop_width, crop_height = jpeg_crops[idx]
+            else:
+                cropped = crop_bounding_box(image, bbox)
+                # Encode once; the same bytes feed the upload and the local copy
+                payload = encode_jpeg(cropped)
+                crop_width, crop_height = cropped.size
             
             # Generate filename - prioritize window naming
             label = bbox.label or f"crop_{idx+1}"
@@ -668,24 +970,19 @@ def process_single_image(
                 label = f"window_{window_count}"
             
             # Sanitize label for filename
-            safe_label = "".join(c if c.isalnum() or c in ('-', '_') else '_' for c in label)
+            safe_label = _safe_filename_part(label)
             filename_prefix = build_filename_prefix(source)
             filename = f"{filename_prefix}_crop_{idx+1:03d}_{safe_label}.jpg"
             out_path = job_dir / filename
             
-            # Save cropped image to bytes
-            img_bytes = io.BytesIO()
-            cropped.save(img_bytes, format="JPEG", quality=95)
-            img_bytes.seek(0)
-            
             # Upload to cloud storage and get URL
-            image_url_result = upload_to_cloud_storage(img_bytes, filename)
+            image_url_result = upload_to_cloud_storage(payload, filename)
             
             # Optionally save locally (set SAVE_LOCAL=false to avoid filling server disk)
             if SAVE_LOCAL:
                 try:
                     out_path.parent.mkdir(parents=True, exist_ok=True)
-                    cropped.save(str(out_path), "JPEG", quality=95)
+                    out_path.write_bytes(payload)
                 except Exception:
                     pass
             
@@ -696,8 +993,8 @@ def process_single_image(
                 "label": label,
                 **source,
                 "dimensions": {
-                    "width": cropped.width,
-                    "height": cropped.height
+                    "width": crop_width,
+                    "height": crop_height
                 },
                 "bbox": {
                     "x": bbox.x,
@@ -718,8 +1015,38 @@ def process_single_image(
     return saved_files, errors, source_item
 
 
+def select_outputs_to_purge(clear_previous: bool) -> List[Path]:
+    """
+    List previous outputs to delete: everything if clear_previous, otherwise job dirs
+    older than CROP_JOB_MAX_AGE_MINUTES (keeps disk from growing).
+    """
+    if not OUTPUT_DIR.exists():
+        return []
+    try:
+        if clear_previous:
+            return list(OUTPUT_DIR.iterdir())
+        if CROP_JOB_MAX_AGE_MINUTES > 0:
+            cutoff = time.time() - (CROP_JOB_MAX_AGE_MINUTES * 60)
+            return [item for item in OUTPUT_DIR.iterdir() if item.is_dir() and item.stat().st_mtime < cutoff]
+    except Exception:
+        pass
+    return []
+
+
+def purge_paths(paths: List[Path]) -> None:
+    """Delete output files/dirs; runs on CLEANUP_EXECUTOR so it stays off the request path."""
+    for item in paths:
+        try:
+            if item.is_dir():
+                shutil.rmtree(item, ignore_errors=True)
+            elif item.is_file():
+                item.unlink()
+        except Exception:
+            pass
+
+
 @app.post("/crop-image")
-async def crop_image(request: CropRequest = Body(...)) -> JSONResponse:
+async def crop_image(request: CropRequest = Body(...)) -> Dict[str, Any]:
     """Crop bounding boxes from one or more image URLs. Detects and crops all windows if requested."""
     
     # Validate input
@@ -728,28 +1055,17 @@ async def crop_image(request: CropRequest = Body(...)) -> JSONResponse:
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     
-    # Clear previous cropped images if requested
-    if request.clear_previous:
-        try:
-            if OUTPUT_DIR.exists():
-                for item in OUTPUT_DIR.iterdir():
-                    if item.is_dir():
-                        shutil.rmtree(item)
-                    elif item.is_file():
-                        item.unlink()
-        except Exception:
-            pass
+    # Pick the outputs to delete now, before this job's dir exists; they are deleted off the request
+    # path once the request finishes, whether it succeeds or fails
+    stale_outputs = select_outputs_to_purge(request.clear_previous)
+    try:
+        return process_crop_request(request, image_urls)
+    finally:
+        CLEANUP_EXECUTOR.submit(purge_paths, stale_outputs)
 
-    # Cleanup old job dirs to prevent disk from growing (CROP_JOB_MAX_AGE_MINUTES)
-    if CROP_JOB_MAX_AGE_MINUTES > 0 and OUTPUT_DIR.exists():
-        try:
-            cutoff = time.time() - (CROP_JOB_MAX_AGE_MINUTES * 60)
-            for item in OUTPUT_DIR.iterdir():
-                if item.is_dir() and item.stat().st_mtime < cutoff:
-                    shutil.rmtree(item, ignore_errors=True)
-        except Exception:
-            pass
 
+def process_crop_request(request: CropRequest, image_urls: List[str]) -> Dict[str, Any]:
+    """Run a validated crop request in a fresh job dir and build the response."""
     job_id = uuid.uuid4().hex
     ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
     job_dir = OUTPUT_DIR / f"{ts}_{job_id}"
@@ -759,29 +1075,61 @@ async def crop_image(request: CropRequest = Body(...)) -> JSONResponse:
     all_errors: List[str] = []
     source_items: List[Dict[str, Any]] = []
     
-    # Process each image
-    for idx, image_url in enumerate(image_urls):
-        try:
-            saved_files, errors, source_item = process_single_image(image_url, request, job_dir, image_index=idx)
-            all_saved_files.extend(saved_files)
-            all_errors.extend(errors)
-            source_items.append(source_item)
-        except HTTPException:
-            raise
-        except Exception as e:
-            message = f"Failed to process image {idx + 1} ({image_url}): {e}"
-            all_errors.append(message)
-            source = build_source_metadata(request, image_url, idx)
-            source_items.append({
-                **source,
-                "status": "failed",
-                "saved_count": 0,
-                "crops": [],
-                "errors": [message],
-                "detection_attempts": [],
-            })
+    # Manual boxes without detection can be cropped from the JPEG bytes, so skip the full decode
+    crop_from_bytes = not request.use_detection and bool(request.bounding_boxes) and get_turbojpeg() is not None
+    fetch = download_image_bytes if crop_from_bytes else download_image
+
+    # Work through the URLs one YOLO batch at a time, so only one chunk of decoded images is held in memory
+    with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_MAX_WORKERS, YOLO_MAX_BATCH, len(image_urls)))) as executor:
+        for chunk_start in range(0, len(image_urls), YOLO_MAX_BATCH):
+            chunk_urls = image_urls[chunk_start:chunk_start + YOLO_MAX_BATCH]
+            downloads = list(executor.map(fetch, chunk_urls))
+            images: List[Optional[Image.Image]] = [None] * len(downloads) if crop_from_bytes else downloads
+            image_data: List[Optional[bytes]] = downloads if crop_from_bytes else [None] * len(downloads)
+            detections: List[Optional[List[BoundingBox]]] = [None] * len(images)
+            if request.use_detection:
+                detections = detect_objects_batch(
+                    images,
+                    request.confidence_threshold,
+                    windows_only=request.detect_windows_only
+                )
+
+            # Process each image
+            for offset, (image_url, image, data, detected_boxes) in enumerate(zip(chunk_urls, images, image_data, detections)):
+                idx = chunk_start + offset
+                try:
+                    saved_files, errors, source_item = process_single_image(
+                        image_url,
+                        request,
+                        job_dir,
+                        image_index=idx,
+                        image=image,
+                        detected_boxes=detected_boxes,
+                        image_bytes=data
+                    )
+                    all_saved_files.extend(saved_files)
+                    all_errors.extend(errors)
+                    source_items.append(source_item)
+                except HTTPException:
+                    raise
+                except Exception as e:
+                    message = f"Failed to process image {idx + 1} ({image_url}): {e}"
+                    all_errors.append(message)
+                    source = build_source_metadata(request, image_url, idx)
+                    source_items.append({
+                        **source,
+                        "status": "failed",
+                        "saved_count": 0,
+                        "crops": [],
+                        "errors": [message],
+                        "detection_attempts": [],
+                    })
+
+            # Release this chunk's images before downloading the next one
+            del downloads, images, image_data, detections, image, data
     
-    return JSONResponse({
+    # Returned as a plain dict so FastAPI serializes it with Pydantic's JSON encoder
+    return {
         "status": "success",
         "job_id": job_id,
         "batch_id": request.batch_id or job_id,
@@ -791,7 +1139,7 @@ async def crop_image(request: CropRequest = Body(...)) -> JSONResponse:
         "saved_files": all_saved_files,
         "source_items": source_items,
         "errors": all_errors,
-    })
+    }
 
 
 @app.get("/")